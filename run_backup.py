@@ -2,6 +2,8 @@
 import os
 import sys
 import json
+import time
+import fcntl
 import logging
 import requests
 import smtplib
@@ -29,6 +31,9 @@ class Config:
 
     # ---------- Scheduler ----------
     RUN_LOOKBACK_MINUTES = 5  # minutes to look back from "now"
+    RUN_DEADLINE_SECONDS = int(os.getenv("RUN_DEADLINE_SECONDS", 270))  # stop taking new tenants after this
+    LOCK_FILE = os.getenv("LOCK_FILE", "backup_run.lock")
+    DEFERRED_FILE = os.getenv("DEFERRED_FILE", "deferred_tenants.json")
 
     # ---------- Google Sheets ----------
     SHEETS_USE_GSHEETS = os.getenv("SHEETS_USE_GSHEETS", "true").lower() == "true"
@@ -107,6 +112,7 @@ class Config:
 
     # ---------- Business rules ----------
     PN_PER_PILOT_PER_VN = int(os.getenv("PN_PER_PILOT_PER_VN", 1))
+    COVERAGE_VNS_PER_QUERY = int(os.getenv("COVERAGE_VNS_PER_QUERY", 500))  # max VNs per tenant PhysicalVirtualMap lookup
 
     # ---------- Database Table Names ----------
     TABLES = {
@@ -385,6 +391,78 @@ def compute_time_window(lookback_minutes):
     return start_of_day, end_time
 
 
+def acquire_run_lock(path):
+    """
+    Take an exclusive, non-blocking lock so overlapping cron runs exit fast
+    Returns the open lock file (keep it open for the whole run) or None if not acquired
+    """
+    log = logging.getLogger(__name__)
+    try:
+        lock_fh = open(path, "a+")
+    except OSError as e:
+        log.error(f"Cannot open lock file {path}: {e}")
+        return None
+    
+    try:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_fh.close()
+        log.warning(f"Another run holds {path}")
+        return None
+    except OSError as e:
+        lock_fh.close()
+        log.error(f"Cannot lock {path}: {e}")
+        return None
+    
+    lock_fh.seek(0)
+    lock_fh.truncate()
+    lock_fh.write(f"{os.getpid()}\n")
+    lock_fh.flush()
+    return lock_fh
+
+
+def load_deferred_tenants(path):
+    """Load AccountSids deferred by a previous run that hit its deadline"""
+    log = logging.getLogger(__name__)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            return json.load(f).get("deferred", [])
+    except Exception as e:
+        log.error(f"Failed to read deferred tenants file {path}: {e}")
+        return []
+
+
+def save_deferred_tenants(path, tenant_ids):
+    """Persist deferred AccountSids so the next run processes them first"""
+    log = logging.getLogger(__name__)
+    try:
+        if not tenant_ids:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "deferred": tenant_ids,
+                "saved_at": datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            }, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        log.error(f"Failed to write deferred tenants file {path}: {e}")
+
+
+def prioritize_deferred(accounts, deferred_ids):
+    """Move tenants deferred by the previous run to the front, keeping relative order"""
+    deferred = set(deferred_ids)
+    return (
+        [a for a in accounts if a.get("AccountSid") in deferred]
+        + [a for a in accounts if a.get("AccountSid") not in deferred]
+    )
+
+
 # ============================================================
 # CORE BUSINESS LOGIC
 # ============================================================
@@ -414,6 +492,42 @@ class BackupPNProcessor:
         self.log.info(f"Found {len(rows)} purchased VNs for tenant {tenant_id}")
         return rows
     
+    def get_existing_backup_counts(self, vn_numbers):
+        """
+        Load existing backup PN counts from PhysicalVirtualMap for the given VNs
+        Returns: {vn_number: {pilot: count}}
+        Called once per tenant; issues one bulk query per COVERAGE_VNS_PER_QUERY VNs
+        """
+        coverage = {}
+        vn_numbers = list(dict.fromkeys(vn_numbers))
+        batch_size = max(1, Config.COVERAGE_VNS_PER_QUERY)
+        
+        for i in range(0, len(vn_numbers), batch_size):
+            batch = vn_numbers[i:i + batch_size]
+            placeholders = ", ".join(["%s"] * len(batch))
+            query = """
+            SELECT 
+                m.VirtualNumber AS vn_number,
+                p.pilot,
+                COUNT(*) AS backup_count
+            FROM {{pvm}} m
+            JOIN {{available_pns}} a
+                ON m.PhysicalNumber = a.PhoneNumber
+            JOIN {{pri}} p
+                ON a._Pri = p.id
+            WHERE 
+                m.VirtualNumber IN ({placeholders})
+            GROUP BY m.VirtualNumber, p.pilot
+            """.format(placeholders=placeholders)
+            
+            rows = DatabasePool.fetchall(query, tuple(batch))
+            for row in rows:
+                pilot_counts = coverage.setdefault(row["vn_number"], {})
+                pilot_counts[str(row["pilot"])] = int(row["backup_count"])
+        
+        self.log.info(f"Loaded existing backup coverage for {len(coverage)}/{len(vn_numbers)} VNs")
+        return coverage
+    
     def is_pilot_active(self, pilot):
         """Check if pilot is active in PRI table"""
         query = """
@@ -504,22 +618,37 @@ class BackupPNProcessor:
             return None
         
         results = []
+        needed_per_pilot = Config.PN_PER_PILOT_PER_VN
+        
+        # Step 2: Load backups attached by earlier runs so only missing (VN, pilot) slots are planned
+        coverage = self.get_existing_backup_counts([vn["vn_number"] for vn in purchased_vns])
         
-        # Step 2: Process each purchased VN
+        # Step 3: Process each purchased VN
+        handled_vns = set()
         for vn in purchased_vns:
-            vn_number = vn["PhoneNumber"]
+            vn_number = vn["vn_number"]
             region = vn.get("Region")
             
+            # The purchased-VN join can return the same VN more than once
+            if vn_number in handled_vns:
+                self.log.info(f"VN {vn_number} already handled in this run, skipping duplicate row")
+                continue
+            handled_vns.add(vn_number)
+            
+            existing = coverage.get(vn_number, {})
+            
             vn_result = {
                 "vn": vn_number,
                 "region": region,
                 "assigned": [],
+                "existing": sum(existing.values()),
+                "covered": False,
                 "warnings": []
             }
             
             self.log.info(f"Processing VN: {vn_number} (Region: {region})")
             
-            # Step 3: Determine pilots to use
+            # Step 4: Determine pilots to use
             # Check if tenant has operator exceptions
             if tenant_id in tenant_exceptions:
                 pilots = tenant_exceptions[tenant_id]
@@ -534,17 +663,28 @@ class BackupPNProcessor:
                 results.append(vn_result)
                 continue
             
-            # Step 4: Add backup PNs from each pilot
-            needed_per_pilot = Config.PN_PER_PILOT_PER_VN
+            # Plan only the pilots still short of backups for this VN
+            missing = {
+                pilot: needed_per_pilot - existing.get(pilot, 0)
+                for pilot in pilots
+                if needed_per_pilot - existing.get(pilot, 0) > 0
+            }
+            
+            if not missing:
+                self.log.info(f"VN {vn_number} already has {needed_per_pilot} backup(s) from each pilot, skipping")
+                vn_result["covered"] = True
+                results.append(vn_result)
+                continue
             
-            for pilot in pilots:
+            # Step 5: Add missing backup PNs from each pilot
+            for pilot, needed in missing.items():
                 # Check if pilot is active
                 if not self.is_pilot_active(pilot):
                     vn_result["warnings"].append(f"Pilot {pilot} is inactive/dead")
                     continue
                 
                 # Fetch available PNs from this pilot
-                available_pns = self.fetch_available_pns_for_pilot(pilot, region, needed_per_pilot)
+                available_pns = self.fetch_available_pns_for_pilot(pilot, region, needed)
                 
                 if not available_pns:
                     vn_result["warnings"].append(f"No available PNs from pilot {pilot}")
@@ -594,11 +734,13 @@ def build_email_report(tenant, results):
     
     total_vns = len(results)
     total_assigned = sum(len(r["assigned"]) for r in results)
+    total_existing = sum(r.get("existing", 0) for r in results)
     total_warnings = sum(len(r["warnings"]) for r in results)
     
     lines.append(f"Summary:")
     lines.append(f"  - Virtual Numbers Processed: {total_vns}")
     lines.append(f"  - Backup PNs Added: {total_assigned}")
+    lines.append(f"  - Backup PNs Already Present: {total_existing}")
     lines.append(f"  - Warnings: {total_warnings}")
     lines.append("")
     
@@ -610,6 +752,10 @@ def build_email_report(tenant, results):
             lines.append(f"   Assigned Backup PNs ({len(r['assigned'])}):")
             for a in r["assigned"]:
                 lines.append(f"      • {a['pn']} (Pilot: {a['pilot']})")
+        elif r.get("covered"):
+            lines.append(f"   Already covered ({r['existing']} existing backup PNs)")
+        elif r.get("existing"):
+            lines.append(f"   ⚠ No backup PNs assigned ({r['existing']} existing backup PNs)")
         else:
             lines.append(f"   ⚠ No backup PNs assigned")
         
@@ -631,8 +777,24 @@ def main():
     setup_logging()
     log = logging.getLogger("main")
     
+    # Single-instance guard: a slow run must not overlap the next cron tick
+    lock_fh = acquire_run_lock(Config.LOCK_FILE)
+    if lock_fh is None:
+        log.warning("Run lock not acquired. Exiting.")
+        return
+    
+    try:
+        run(log)
+    finally:
+        lock_fh.close()
+
+
+def run(log):
+    run_started = time.monotonic()
+    
     log.info("=" * 70)
     log.info("Starting Backup PN Automation")
+    log.info(f"Run deadline: {Config.RUN_DEADLINE_SECONDS}s")
     log.info("=" * 70)
     
     # Initialize database pool
@@ -652,14 +814,28 @@ def main():
         log.warning("No active accounts found. Exiting.")
         return
     
+    # Tenants deferred by the previous run go first
+    previously_deferred = load_deferred_tenants(Config.DEFERRED_FILE)
+    if previously_deferred:
+        log.info(f"Processing {len(previously_deferred)} tenants deferred by previous run first")
+        accounts = prioritize_deferred(accounts, previously_deferred)
+    
     # Initialize processor
     processor = BackupPNProcessor()
     
     # Process each tenant
     success_count = 0
     error_count = 0
-    
-    for account in accounts:
+    deferred = []
+    
+    for idx, account in enumerate(accounts):
+        # Stop taking new tenants once the deadline has passed (always process at least one)
+        if idx > 0 and time.monotonic() - run_started >= Config.RUN_DEADLINE_SECONDS:
+            deferred = [a.get("AccountSid") for a in accounts[idx:]]
+            log.warning(f"Run deadline of {Config.RUN_DEADLINE_SECONDS}s reached, "
+                        f"deferring {len(deferred)} tenants: {', '.join(deferred)}")
+            break
+        
         try:
             log.info("")
             results = processor.process_tenant(
@@ -691,11 +867,13 @@ def main():
                 f"Error processing tenant {account.get('AccountSid')}:\n\n{str(e)}"
             )
     
+    save_deferred_tenants(Config.DEFERRED_FILE, deferred)
+    
     # Final summary
     log.info("")
     log.info("=" * 70)
     log.info("Backup PN Automation Completed")
-    log.info(f"Success: {success_count} | Errors: {error_count}")
+    log.info(f"Success: {success_count} | Errors: {error_count} | Deferred: {len(deferred)}")
     log.info("=" * 70)
 
 